@@ -1,21 +1,30 @@
-# I_suck_at_golf — Telegram bot (Background Worker, long-polling)
-# Requirements: python-telegram-bot==21.3  (или 22.x)
+# I_suck_at_golf — Telegram bot (webhook на Render, long-polling локально)
+# Requirements: python-telegram-bot[webhooks]==21.3  (или 22.x)
 # Render: Build -> pip install -r requirements.txt
 #         Start -> python -u golf_bot.py
 # Env var: BOT_TOKEN=<ваш токен от BotFather>
+#          WEBHOOK_URL=<публичный https-адрес сервиса>  (без него — polling)
+#          PORT=<порт, Render задаёт сам>, WEBHOOK_SECRET=<опционально>
+#          DATA_DIR=<каталог для журналов ударов и состояния бота, по умолчанию ./data>
 
-import os, sys, traceback, platform, io, csv, uuid
-from dataclasses import dataclass, asdict
-from collections import defaultdict, Counter
+import os, sys, traceback, platform, io, csv, secrets, asyncio, time, operator, pickle, threading
+from dataclasses import dataclass
+from collections import defaultdict
 from datetime import datetime
 
 from telegram import (
-    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile
+    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 )
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
+    ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters,
+    PicklePersistence, PersistenceInput
 )
 
+try:
+    import numpy as np  # приходит вместе с pandas
+except ImportError:
+    np = None
+
 # ======= STARTUP / ENV =======
 print("Starting I_suck_at_golf…", flush=True)
 print(f"Python: {platform.python_version()}", flush=True)
@@ -27,6 +36,11 @@ if not TOKEN:
 
 BOT_NAME = "I_suck_at_golf"
 
+# Webhook: если WEBHOOK_URL не задан — падаем обратно на polling (локальная разработка)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
 # ======= CONSTANTS =======
 ARW_UP, ARW_DOWN, ARW_RIGHT, ARW_LEFT = "⬆️", "⬇️", "➡️", "⬅️"
 
@@ -65,9 +79,35 @@ RESULT_PUTT = [ARW_UP, ARW_DOWN, ARW_RIGHT, ARW_LEFT, "⛳️"]
 CONTACT_PUTT = ["toe", "heel", "good ⛳️"]
 LAG_PUTT = ["good reading", "poor reading"]
 
+MODES = ["practice", "on course"]
+
+def canon(items: list[str]) -> dict[str, str]:
+    """Ввод → канонический (interned) экземпляр строки; None — ввод не из меню."""
+    return {x: x for x in map(sys.intern, items)}
+
+# Проверка ввода и нормализация значений (списки выше — для порядка кнопок и колонок CSV).
+# В Shot сохраняем значение из словаря, а не текст сообщения: одна строка на все удары.
+LIES_MAP = canon(LIES)
+CLUBS_MAP = canon(CLUBS)
+SHOT_TYPES_MAP = canon(SHOT_TYPES)
+RESULT_NON_PUTT_MAP = canon(RESULT_NON_PUTT)
+CONTACT_NON_PUTT_MAP = canon(CONTACT_NON_PUTT)
+PLAN_MAP = canon(PLAN_CHOICES)
+PUTT_DISTANCE_MAP = canon(PUTT_DISTANCE)
+RESULT_PUTT_MAP = canon(RESULT_PUTT)
+CONTACT_PUTT_MAP = canon(CONTACT_PUTT)
+LAG_MAP = canon(LAG_PUTT)
+MODES_MAP = {"practice": "practice", "on course": "oncourse"}
+
 # ======= DATA =======
-@dataclass
+# Shot лежит в user_data и пиклится в bot_state.pkl по ссылке «модуль.класс».
+# Фиксируем имя модуля, чтобы состояние грузилось и при `python golf_bot.py` (__main__), и при импорте.
+sys.modules.setdefault("golf_bot", sys.modules[__name__])
+
+@dataclass(slots=True)
 class Shot:
+    __module__ = "golf_bot"
+
     timestamp: str
     mode: str            # "practice" | "oncourse"
     session_id: str
@@ -93,13 +133,7 @@ class Shot:
     putt_plan_2: str | None = None
 
     def as_row(self):
-        return [
-            self.timestamp, self.mode, self.session_id, self.hole,
-            self.lie, self.club, self.shot_type,
-            self.result, self.contact, self.plan,
-            self.putt_distance, self.putt_result, self.putt_contact,
-            self.putt_plan_1, self.lag_reading, self.putt_plan_2
-        ]
+        return list(_SHOT_GETTER(self))
 
 RAW_HEADER = [
     "timestamp","mode","session_id","hole",
@@ -108,44 +142,75 @@ RAW_HEADER = [
     "putt_distance","putt_result","putt_contact",
     "putt_plan_1","lag_reading","putt_plan_2"
 ]
+# все поля Shot за один C-вызов, в порядке RAW_HEADER
+_SHOT_GETTER = operator.attrgetter(*RAW_HEADER)
 
 # ======= HELPERS =======
 def kb(rows): return ReplyKeyboardMarkup(rows, resize_keyboard=True, one_time_keyboard=True)
-def now_iso(): return datetime.now().isoformat(timespec="seconds")
+_now_cache = (0, "")  # (секунда, строка) — удары в одну секунду делят одну строку
+def now_iso():
+    global _now_cache
+    t = int(time.time())
+    if t != _now_cache[0]:
+        _now_cache = (t, datetime.fromtimestamp(t).isoformat(timespec="seconds"))
+    return _now_cache[1]
+def new_session_id(): return secrets.token_hex(8)  # непрозрачная метка сессии в CSV
 def pct(a, b): return 0.0 if not b else round(a * 100.0 / b, 1)
+def pct_list(counts: list[int], b: int) -> list[float]:
+    if not b: return [0.0] * len(counts)
+    if np is None: return [pct(a, b) for a in counts]
+    return (np.array(counts, dtype=np.int64) * 100.0 / b).round(1).tolist()
 def club_name(c: str | None) -> str: return c or "—"
 
+# Сохранённые удары храним по колонкам: {поле: [значения]} в порядке RAW_HEADER
+ShotColumns = dict[str, list]
+def new_shot_columns() -> ShotColumns: return {f: [] for f in RAW_HEADER}
+def shot_count(cols: ShotColumns) -> int: return len(cols["timestamp"])
+def snapshot_columns(cols: ShotColumns) -> ShotColumns: return {f: col[:] for f, col in cols.items()}
+def append_shot(cols: ShotColumns, s: Shot):
+    for col, value in zip(cols.values(), s.as_row()):
+        col.append(value)
+
 def ensure_session(ctx: ContextTypes.DEFAULT_TYPE):
-    if "core" not in ctx.user_data:
-        ctx.user_data["core"] = {}
-    core = ctx.user_data["core"]
-    core.setdefault("session_id", str(uuid.uuid4()))
-    core.setdefault("mode", None)              # "practice" / "oncourse"
-    core.setdefault("shots", [])               # list[Shot]
-    core.setdefault("current", None)           # building Shot
-    core.setdefault("stack", [])               # back snapshots
-    core.setdefault("practice", {"lie": None, "club": None})
-    core.setdefault("round", {"hole": 1})
-    core.setdefault("awaiting_end_stats", False) # ждём подтверждение выгрузки статистики?
+    core = ctx.user_data.get("core")
+    if core is not None:                       # горячий путь: сессия уже есть
+        return core
+    core = ctx.user_data["core"] = {
+        "session_id": new_session_id(),
+        "mode": None,                          # "practice" / "oncourse"
+        "shots": new_shot_columns(),           # сохранённые удары по колонкам
+        "current": None,                       # building Shot
+        "stack": [],                           # undo log: (field, prev value)
+        "practice": {"lie": None, "club": None},
+        "round": {"hole": 1},
+        "awaiting_end_stats": False,           # ждём подтверждение выгрузки статистики?
+        "router": "mode",                      # ключ ROUTES для any_text (меняется при смене режима/sticky)
+        "log_pending": [],                     # строки журнала, ещё не дописанные в DATA_DIR/<session_id>.csv
+        "log_written": 0,                      # сколько строк сессии уже отдано в журнал (номер log_pending[0])
+        "keyboard": None,                      # ключ KEYBOARDS клавиатуры на экране; None — её нет
+    }
     return core
 
 def start_new_shot(core):
-    s = Shot(timestamp=now_iso(), mode=core["mode"], session_id=core["session_id"])
-    if core["mode"] == "oncourse":
+    mode = core["mode"]
+    s = Shot(timestamp=now_iso(), mode=mode, session_id=core["session_id"])
+    if mode == "oncourse":
         s.hole = core["round"]["hole"]
-    if core["mode"] == "practice":
-        s.lie = core["practice"]["lie"]
-        s.club = core["practice"]["club"]
+    elif mode == "practice":
+        practice = core["practice"]
+        s.lie = practice["lie"]
+        s.club = practice["club"]
     core["current"] = s
     core["stack"] = []
 
-def push_state(core):
-    core["stack"].append(asdict(core["current"]))
+def push_state(core, field: str):
+    # undo-лог: (поле, прежнее значение) перед изменением одного поля
+    core["stack"].append((field, getattr(core["current"], field)))
 
 def pop_state(core):
     if core["stack"]:
-        prev = core["stack"].pop()
-        core["current"] = Shot(**prev)
+        field, prev = core["stack"].pop()
+        setattr(core["current"], field, prev)
         return True
     return False
 
@@ -170,62 +235,118 @@ def summarize(s: Shot) -> str:
 
     return "\n".join(lines)
 
+# ======= SHOT LOG =======
+# Подтверждённые удары дописываются в DATA_DIR/<session_id>.csv (формат raw_shots.csv),
+# чтобы рестарт воркера не терял сессию. Строки копятся в core["log_pending"] (он же пиклится
+# вместе с user_data) и дописываются пачкой раз в SHOT_LOG_FLUSH_EVERY ударов, при закрытии
+# сессии и при остановке бота. Файл открываем только на время записи и не в event loop.
+# Пикл user_data отстаёт от журнала до STATE_FLUSH_INTERVAL: после рестарта в log_pending могут
+# вернуться уже записанные строки, поэтому запись сверяется с числом строк в файле (log_written).
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+SHOT_LOG_FLUSH_EVERY = 16
+# user_data (сессии) переживает рестарт; на диск пишется раз в STATE_FLUSH_INTERVAL секунд (см. STATE)
+STATE_FILE = os.path.join(DATA_DIR, "bot_state.pkl")
+STATE_FLUSH_INTERVAL = 5.0
+
+_shot_log_lock = threading.Lock()   # подсчёт строк и дозапись одного файла не должны перемежаться
+
+def write_shot_log(session_id: str, start: int, rows: list[list]):
+    """Дописать rows (строки сессии с номера start), пропустив те, что уже есть в файле."""
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with _shot_log_lock, open(os.path.join(DATA_DIR, f"{session_id}.csv"), "a+",
+                                  newline="", encoding="utf-8") as f:
+            f.seek(0)
+            lines = sum(1 for _ in f)           # заголовок + уже записанные удары
+            w = csv.writer(f)                   # режим "a+": запись всегда в конец файла
+            if lines == 0:
+                w.writerow(RAW_HEADER)
+            w.writerows(rows[max(lines - 1 - start, 0):])
+    except OSError as e:
+        print(f"WARNING: shot log write failed for session {session_id}: {e}", file=sys.stderr, flush=True)
+
+def take_shot_log(core):
+    """Забрать накопленные строки журнала (синхронно, до смены session_id)."""
+    rows = core["log_pending"]
+    if not rows:
+        return None
+    start = core["log_written"]
+    core["log_pending"] = []
+    core["log_written"] = start + len(rows)
+    return core["session_id"], start, rows
+
+async def save_shot_log(pending):
+    if pending is not None:
+        await asyncio.to_thread(write_shot_log, *pending)
+
 # ======= GLOBAL CONTROLS =======
 async def go_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Сброс и возврат на выбор режима."""
     core = ensure_session(context)
+    pending = take_shot_log(core)
     core["mode"] = None
-    core["shots"] = []
+    core["router"] = "mode"
+    core["shots"] = new_shot_columns()
     core["current"] = None
     core["stack"] = []
     core["practice"] = {"lie": None, "club": None}
     core["round"] = {"hole": 1}
     core["awaiting_end_stats"] = False
-    await update.message.reply_text(
+    await save_shot_log(pending)
+    await reply(
+        update, core,
         f"Hi! This is {BOT_NAME}.\nChoose mode:",
-        reply_markup=kb_mode()
+        keyboard=KB_MODE
     )
 
 async def end_session_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Завершение сессии (и в practice, и в on course)."""
     core = ensure_session(context)
-    core["session_id"] = str(uuid.uuid4())
-    core["shots"] = []
+    pending = take_shot_log(core)
+    core["session_id"] = new_session_id()
+    core["log_written"] = 0
+    core["shots"] = new_shot_columns()
     core["current"] = None
     core["stack"] = []
     core["awaiting_end_stats"] = False
     if core["mode"] == "practice":
         core["practice"] = {"lie": None, "club": None}
-        await update.message.reply_text("Session ended. Practice setup: pick Lie.", reply_markup=kb_lie())
+        core["router"] = "practice_setup"
+        msg, markup = "Session ended. Practice setup: pick Lie.", KB_LIE
     elif core["mode"] == "oncourse":
         core["round"] = {"hole": 1}
-        await update.message.reply_text("Session ended. On-course: Hole = 1. Use /shot.", reply_markup=ReplyKeyboardRemove())
+        msg, markup = "Session ended. On-course: Hole = 1. Use /shot.", KB_REMOVE
     else:
-        await update.message.reply_text("Session ended. Use /start to choose mode.", reply_markup=kb_mode())
+        msg, markup = "Session ended. Use /start to choose mode.", KB_MODE
+    # журнал пишем только после всех правок core: параллельный апдейт не увидит полусброшенную сессию
+    await save_shot_log(pending)
+    await reply(update, core, msg, keyboard=markup)
 
-async def send_stats_files(update: Update, shots: list[Shot]):
+async def send_stats_files(update: Update, shots: ShotColumns):
     """Отправка двух CSV как при /stats."""
-    if not shots:
+    if not shot_count(shots):
         await update.message.reply_text("No shots in this session — nothing to export.")
         return
-    rows = compute_stats_by_club(shots)
-    stats_file = csv_bytes_from_rows(rows); stats_file.name = "stats_by_club.csv"
-    raw_file = raw_csv_bytes(shots);        raw_file.name  = "raw_shots.csv"
+    # CSV собираем в отдельном потоке, чтобы не блокировать event loop
+    stats_file, raw_file = await asyncio.to_thread(build_stats_files, snapshot_columns(shots))
 
     await update.message.reply_text(
         "Statistics are percentages per club within the current session.\n"
         "Sending two CSVs for Google Sheets:"
     )
-    await update.message.reply_document(InputFile(stats_file))
-    await update.message.reply_document(InputFile(raw_file))
+    await asyncio.gather(
+        update.message.reply_document(document=stats_file, filename="stats_by_club.csv"),
+        update.message.reply_document(document=raw_file, filename="raw_shots.csv"),
+    )
 
 async def ask_end_session_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Задать вопрос: прислать ли статистику перед завершением сессии."""
     core = ensure_session(context)
     core["awaiting_end_stats"] = True
-    await update.message.reply_text(
+    await reply(
+        update, core,
         "Do you want to receive statistics files for this session before ending?",
-        reply_markup=kb_end_stats_confirm()
+        keyboard=KB_END_STATS_CONFIRM
     )
 
 async def handle_end_session_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> bool:
@@ -235,7 +356,9 @@ async def handle_end_session_choice(update: Update, context: ContextTypes.DEFAUL
         return False
 
     if text == YES_MARK:
-        # отправляем файлы и завершаем сессию
+        # отправляем файлы и завершаем сессию; флаг снимаем до первого await —
+        # иначе повторный ✅ (апдейты обрабатываются параллельно) запустит второй экспорт
+        core["awaiting_end_stats"] = False
         await send_stats_files(update, core["shots"])
         await end_session_action(update, context)
         return True
@@ -245,71 +368,70 @@ async def handle_end_session_choice(update: Update, context: ContextTypes.DEFAUL
         return True
     else:
         # повторим вопрос
-        await update.message.reply_text(
+        await reply(
+            update, core,
             "Please tap ✅ to receive statistics first, or ❌ to end without stats.",
-            reply_markup=kb_end_stats_confirm()
+            keyboard=retry_markup(core, text, KB_END_STATS_CONFIRM)
         )
         return True
 
-async def handle_controls(text: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Обработка управляющих кнопок. True если обработано."""
-    if text == MAIN_MENU:
-        await go_main_menu(update, context)
-        return True
-    if text == END_SESSION_BTN:
-        await ask_end_session_stats(update, context)
-        return True
-    return False
-
 # ======= KEYBOARDS =======
-def kb_mode(): return kb([["practice", "on course"]])
-
+# Клавиатуры одинаковы для всех пользователей — собираем один раз при импорте
 def kb_with_controls(rows: list[list[str]]):
     rows = list(rows)
     rows += [[BACK, MAIN_MENU], [END_SESSION_BTN]]
     return kb(rows)
 
-def kb_lie():
-    rows = [LIES[i:i+3] for i in range(0, len(LIES), 3)]
-    return kb_with_controls(rows)
-
-def kb_club():
-    rows = [CLUBS[i:i+5] for i in range(0, len(CLUBS), 5)]
-    return kb_with_controls(rows)
-
-def kb_type():
-    rows = [SHOT_TYPES[i:i+3] for i in range(0, len(SHOT_TYPES), 3)]
-    return kb_with_controls(rows)
-
-def kb_result(is_putt=False):
-    src = RESULT_PUTT if is_putt else RESULT_NON_PUTT
-    rows = [src[i:i+3] for i in range(0, len(src), 3)]
-    return kb_with_controls(rows)
-
-def kb_contact(is_putt=False):
-    src = CONTACT_PUTT if is_putt else CONTACT_NON_PUTT
-    rows = [src[i:i+3] for i in range(0, len(src), 3)]
-    return kb_with_controls(rows)
-
-def kb_plan():
-    rows = [PLAN_CHOICES]
-    return kb_with_controls(rows)
-
-def kb_putt_distance():
-    rows = [PUTT_DISTANCE]
-    return kb_with_controls(rows)
-
-def kb_lag():
-    rows = [LAG_PUTT]
-    return kb_with_controls(rows)
-
-def kb_confirm():
-    rows = [[CONFIRM, CANCEL]]
-    return kb_with_controls(rows)
-
-def kb_end_stats_confirm():
-    # Подтверждение отправки статистики: ✅ / ❌
-    return kb([[YES_MARK, NO_MARK]])
+def rows_of(src: list[str], n: int) -> list[list[str]]:
+    return [src[i:i+n] for i in range(0, len(src), n)]
+
+KB_MODE = kb([MODES])
+KB_LIE = kb_with_controls(rows_of(LIES, 3))
+KB_CLUB = kb_with_controls(rows_of(CLUBS, 5))
+KB_TYPE = kb_with_controls(rows_of(SHOT_TYPES, 3))
+KB_RESULT_NONPUTT = kb_with_controls(rows_of(RESULT_NON_PUTT, 3))
+KB_RESULT_PUTT = kb_with_controls(rows_of(RESULT_PUTT, 3))
+KB_CONTACT_NONPUTT = kb_with_controls(rows_of(CONTACT_NON_PUTT, 3))
+KB_CONTACT_PUTT = kb_with_controls(rows_of(CONTACT_PUTT, 3))
+KB_PLAN = kb_with_controls([PLAN_CHOICES])
+KB_PUTT_DISTANCE = kb_with_controls([PUTT_DISTANCE])
+KB_LAG = kb_with_controls([LAG_PUTT])
+KB_CONFIRM = kb_with_controls([[CONFIRM, CANCEL]])
+# Подтверждение отправки статистики: ✅ / ❌
+KB_END_STATS_CONFIRM = kb([[YES_MARK, NO_MARK]])
+KB_REMOVE = ReplyKeyboardRemove()
+
+# В core["keyboard"] храним ключ, а не объект клавиатуры: user_data пиклится (см. ROUTES)
+KEYBOARDS = {
+    "mode": KB_MODE, "lie": KB_LIE, "club": KB_CLUB, "type": KB_TYPE,
+    "result_nonputt": KB_RESULT_NONPUTT, "result_putt": KB_RESULT_PUTT,
+    "contact_nonputt": KB_CONTACT_NONPUTT, "contact_putt": KB_CONTACT_PUTT,
+    "plan": KB_PLAN, "putt_distance": KB_PUTT_DISTANCE, "lag": KB_LAG, "confirm": KB_CONFIRM,
+    "end_stats": KB_END_STATS_CONFIRM, "remove": KB_REMOVE,
+}
+_KEYBOARD_KEYS = {id(k): name for name, k in KEYBOARDS.items()}
+
+# Все подписи кнопок. Нажатие кнопки скрывает one-time клавиатуру, поэтому на неверный ввод
+# клавиатуру шага шлём заново, если пришла подпись кнопки или на экране сейчас другая клавиатура
+# (например, KB_MODE после /start посреди удара); на набранный руками текст при клавиатуре
+# этого шага — только текст, она у пользователя и так на месте.
+BUTTON_LABELS = frozenset(
+    LIES + CLUBS + SHOT_TYPES + RESULT_NON_PUTT + CONTACT_NON_PUTT + PLAN_CHOICES
+    + PUTT_DISTANCE + RESULT_PUTT + CONTACT_PUTT + LAG_PUTT + MODES
+    + [BACK, CANCEL, CONFIRM, MAIN_MENU, END_SESSION_BTN, YES_MARK, NO_MARK]
+)
+def retry_markup(core, text: str, keyboard):
+    if text in BUTTON_LABELS or core["keyboard"] != _KEYBOARD_KEYS[id(keyboard)]:
+        return keyboard
+    return None
+
+async def reply(update: Update, core, text: str, keyboard=None):
+    """Ответ пользователю; запоминаем, какая клавиатура после него на экране."""
+    if keyboard is not None:
+        core["keyboard"] = _KEYBOARD_KEYS[id(keyboard)]
+    elif update.message.text in BUTTON_LABELS:
+        core["keyboard"] = None                # нажатие кнопки скрыло one-time клавиатуру
+    return await update.message.reply_text(text, reply_markup=keyboard)
 
 # ======= COMMANDS =======
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -325,71 +447,77 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
-    await update.message.reply_text(
+    await reply(
+        update, core,
         f"Hi! This is {BOT_NAME}.\nChoose mode:",
-        reply_markup=kb_mode()
+        keyboard=KB_MODE
     )
 
 async def handle_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
     text = update.message.text
-    if text not in ["practice", "on course"]:
-        return await update.message.reply_text("Choose mode:", reply_markup=kb_mode())
-
-    core["mode"] = text if text != "on course" else "oncourse"
-    core["session_id"] = str(uuid.uuid4())
-    core["shots"] = []
+    mode = MODES_MAP.get(text)
+    if mode is None:
+        return await reply(update, core, "Choose mode:", keyboard=retry_markup(core, text, KB_MODE))
+
+    core["mode"] = mode
+    pending = take_shot_log(core)
+    core["session_id"] = new_session_id()
+    core["log_written"] = 0
+    core["shots"] = new_shot_columns()
     core["current"] = None
     core["stack"] = []
     core["awaiting_end_stats"] = False
 
     if core["mode"] == "practice":
         core["practice"] = {"lie": None, "club": None}
-        return await update.message.reply_text("Practice selected.\nPick Lie:", reply_markup=kb_lie())
+        core["router"] = "practice_setup"
+        await save_shot_log(pending)
+        return await reply(update, core, "Practice selected.\nPick Lie:", keyboard=KB_LIE)
     else:
         core["round"] = {"hole": 1}
-        return await update.message.reply_text(
+        core["router"] = "shot"
+        await save_shot_log(pending)
+        return await reply(
+            update, core,
             "On-course selected.\nHole = 1.\nStart a shot with /shot\nUse /next_hole to advance hole.",
-            reply_markup=ReplyKeyboardRemove()
+            keyboard=KB_REMOVE
         )
 
 # ---- Practice sticky setup ----
+# Вызывается только через any_text: ответ по статистике и управляющие кнопки уже обработаны там.
 async def handle_practice_setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
     if core["mode"] != "practice": return
     text = update.message.text
-
-    # Сначала проверим, не выбирает ли пользователь статистику для end session
-    if core.get("awaiting_end_stats"):
-        handled = await handle_end_session_choice(update, context, text)
-        if handled: return
-
-    # Управляющие кнопки
-    if await handle_controls(text, update, context):
-        return
+    practice = core["practice"]
 
     # LIE
-    if core["practice"]["lie"] is None:
+    if practice["lie"] is None:
         if text == BACK:
-            return await update.message.reply_text("Choose mode:", reply_markup=kb_mode())
-        if text in LIES:
-            core["practice"]["lie"] = text
-            return await update.message.reply_text(f"Lie: {text}\nNow pick Club:", reply_markup=kb_club())
-        return await update.message.reply_text("Pick Lie:", reply_markup=kb_lie())
+            return await reply(update, core, "Choose mode:", keyboard=KB_MODE)
+        lie = LIES_MAP.get(text)
+        if lie is not None:
+            practice["lie"] = lie
+            return await reply(update, core, f"Lie: {lie}\nNow pick Club:", keyboard=KB_CLUB)
+        return await reply(update, core, "Pick Lie:", keyboard=retry_markup(core, text, KB_LIE))
 
     # CLUB
-    if core["practice"]["club"] is None:
+    if practice["club"] is None:
         if text == BACK:
-            core["practice"]["lie"] = None
-            return await update.message.reply_text("Pick Lie:", reply_markup=kb_lie())
-        if text in CLUBS:
-            core["practice"]["club"] = text
+            practice["lie"] = None
+            return await reply(update, core, "Pick Lie:", keyboard=KB_LIE)
+        club = CLUBS_MAP.get(text)
+        if club is not None:
+            practice["club"] = club
+            core["router"] = "shot"
             start_new_shot(core)  # prefill sticky
-            return await update.message.reply_text(
-                f"Sticky set ⛳️\nLie: {core['practice']['lie']} | Club: {core['practice']['club']}\nStart a shot: choose Type",
-                reply_markup=kb_type()
+            return await reply(
+                update, core,
+                f"Sticky set ⛳️\nLie: {practice['lie']} | Club: {club}\nStart a shot: choose Type",
+                keyboard=KB_TYPE
             )
-        return await update.message.reply_text("Pick Club:", reply_markup=kb_club())
+        return await reply(update, core, "Pick Club:", keyboard=retry_markup(core, text, KB_CLUB))
 
     # обе заданы → входим в шаги удара
     await shot_flow(update, context)
@@ -398,9 +526,9 @@ async def handle_practice_setup(update: Update, context: ContextTypes.DEFAULT_TY
 async def cmd_shot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
     if core["mode"] != "oncourse":
-        return await update.message.reply_text("You are not in on-course mode. Use /start.")
+        return await reply(update, core, "You are not in on-course mode. Use /start.")
     start_new_shot(core)
-    await update.message.reply_text(f"Hole {core['round']['hole']}: choose Type", reply_markup=kb_type())
+    await reply(update, core, f"Hole {core['round']['hole']}: choose Type", keyboard=KB_TYPE)
 
 async def cmd_next_hole(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
@@ -410,243 +538,239 @@ async def cmd_next_hole(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Moved to hole {core['round']['hole']}. Add a shot: /shot")
 
 # ---- Stats / CSV ----
-def compute_stats_by_club(shots: list[Shot]):
-    by_club = defaultdict(list)
-    for s in shots:
-        by_club[club_name(s.club)].append(s)
-
-    result_keys = list(dict.fromkeys(RESULT_NON_PUTT + RESULT_PUTT))
-    contact_keys = list(dict.fromkeys([*CONTACT_NON_PUTT, *CONTACT_PUTT]))
-    plan_keys = PLAN_CHOICES
-    lag_keys = LAG_PUTT
-
-    rows = []
-    header = ["Club", "n"] \
-        + [f"Result % {k}" for k in result_keys] \
-        + [f"Contact % {k}" for k in contact_keys] \
-        + [f"Plan % {k}" for k in plan_keys] \
-        + [f"Lag % {k}" for k in lag_keys]
-    rows.append(header)
-
-    for club, lst in by_club.items():
-        N = len(lst)
-        res, con, plan, lag = [], [], [], []
-        for s in lst:
-            if s.shot_type == "putt":
-                if s.putt_result:  res.append(s.putt_result)
-                if s.putt_contact: con.append(s.putt_contact)
-                if s.putt_plan_1:  plan.append(s.putt_plan_1)
-                if s.putt_plan_2:  plan.append(s.putt_plan_2)
-                if s.lag_reading:  lag.append(s.lag_reading)
-            else:
-                if s.result:  res.append(s.result)
-                if s.contact: con.append(s.contact)
-                if s.plan:    plan.append(s.plan)
-
-        rc, cc, pc, lc = Counter(res), Counter(con), Counter(plan), Counter(lag)
-        row = [club, N] \
-            + [pct(rc.get(k, 0), N) for k in result_keys] \
-            + [pct(cc.get(k, 0), N) for k in contact_keys] \
-            + [pct(pc.get(k, 0), N) for k in plan_keys] \
-            + [pct(lc.get(k, 0), N) for k in lag_keys]
-        rows.append(row)
+RESULT_KEYS = tuple(dict.fromkeys(RESULT_NON_PUTT + RESULT_PUTT))
+CONTACT_KEYS = tuple(dict.fromkeys(CONTACT_NON_PUTT + CONTACT_PUTT))
+PLAN_KEYS = tuple(PLAN_CHOICES)
+LAG_KEYS = tuple(LAG_PUTT)
+STATS_HEADER = (
+    "Club", "n",
+    *(f"Result % {k}" for k in RESULT_KEYS),
+    *(f"Contact % {k}" for k in CONTACT_KEYS),
+    *(f"Plan % {k}" for k in PLAN_KEYS),
+    *(f"Lag % {k}" for k in LAG_KEYS),
+)
+
+def compute_stats_by_club(shots: ShotColumns):
+    # Один проход по колонкам: на клюшку — [n, {result: cnt}, {contact: cnt}, {plan: cnt}, {lag: cnt}]
+    per_club = defaultdict(lambda: [0, {}, {}, {}, {}])
+    for club, shot_type, result, contact, plan, putt_result, putt_contact, putt_plan_1, lag, putt_plan_2 in zip(
+            shots["club"], shots["shot_type"], shots["result"], shots["contact"], shots["plan"],
+            shots["putt_result"], shots["putt_contact"], shots["putt_plan_1"],
+            shots["lag_reading"], shots["putt_plan_2"]):
+        acc = per_club[club_name(club)]
+        acc[0] += 1
+        _, rc, cc, pc, lc = acc
+        if shot_type == "putt":
+            if putt_result:  rc[putt_result] = rc.get(putt_result, 0) + 1
+            if putt_contact: cc[putt_contact] = cc.get(putt_contact, 0) + 1
+            if putt_plan_1:  pc[putt_plan_1] = pc.get(putt_plan_1, 0) + 1
+            if putt_plan_2:  pc[putt_plan_2] = pc.get(putt_plan_2, 0) + 1
+            if lag:          lc[lag] = lc.get(lag, 0) + 1
+        else:
+            if result:  rc[result] = rc.get(result, 0) + 1
+            if contact: cc[contact] = cc.get(contact, 0) + 1
+            if plan:    pc[plan] = pc.get(plan, 0) + 1
+
+    rows = []  # без заголовка: он пишется из STATS_HEADER_BYTES
+
+    for club, (N, rc, cc, pc, lc) in per_club.items():
+        counts = [rc.get(k, 0) for k in RESULT_KEYS] \
+            + [cc.get(k, 0) for k in CONTACT_KEYS] \
+            + [pc.get(k, 0) for k in PLAN_KEYS] \
+            + [lc.get(k, 0) for k in LAG_KEYS]
+        rows.append([club, N] + pct_list(counts, N))
     return rows
 
+# С этого размера сессии /stats считаем через pandas (импорт окупается)
+PANDAS_MIN_SHOTS = 200
+
+def stats_csv_bytes_pandas(shots: ShotColumns):
+    """То же, что csv_bytes_from_rows(compute_stats_by_club(shots)), но через pandas."""
+    import pandas as pd
+    df = pd.DataFrame(shots)
+    club = df["club"].fillna(club_name(None))
+    is_putt = df["shot_type"] == "putt"
+    lag = df["lag_reading"].where(is_putt)
+    facets = [
+        (RESULT_KEYS, [df["putt_result"].where(is_putt, df["result"])]),
+        (CONTACT_KEYS, [df["putt_contact"].where(is_putt, df["contact"])]),
+        (PLAN_KEYS, [df["putt_plan_1"].where(is_putt, df["plan"]), df["putt_plan_2"].where(is_putt)]),
+        (LAG_KEYS, [lag]),
+    ]
+
+    clubs = pd.Index(club.unique())
+    n = club.value_counts().reindex(clubs)
+    parts = [n]
+    for keys, series in facets:
+        values = pd.concat(series, ignore_index=True)
+        counts = pd.crosstab(pd.concat([club] * len(series), ignore_index=True), values) \
+            .reindex(index=clubs, columns=list(keys), fill_value=0)
+        parts.append((counts.mul(100.0).div(n, axis=0)).round(1))
+    out = pd.concat(parts, axis=1)
+
+    buf = io.BytesIO()
+    buf.write(STATS_HEADER_BYTES)
+    out.to_csv(buf, header=False, encoding="utf-8", lineterminator="\r\n")
+    buf.seek(0)
+    return buf
+
+def csv_buffer(rows, header: bytes = b"") -> io.BytesIO:
+    # пишем сразу в байтовый буфер, без промежуточной str и .encode();
+    # header — уже закодированная строка заголовка
+    buf = io.BytesIO()
+    buf.write(header)
+    tw = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+    csv.writer(tw).writerows(rows)
+    tw.flush(); tw.detach(); buf.seek(0)
+    return buf
+
+# Заголовки постоянны — кодируем их тем же csv.writer один раз при импорте
+RAW_HEADER_BYTES = csv_buffer([RAW_HEADER]).getvalue()
+STATS_HEADER_BYTES = csv_buffer([STATS_HEADER]).getvalue()
+
 def csv_bytes_from_rows(rows: list[list]):
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    for r in rows: writer.writerow(r)
-    return io.BytesIO(buf.getvalue().encode("utf-8"))
-
-def raw_csv_bytes(shots: list[Shot]):
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(RAW_HEADER)
-    for s in shots: w.writerow(s.as_row())
-    return io.BytesIO(buf.getvalue().encode("utf-8"))
+    return csv_buffer(rows, STATS_HEADER_BYTES)
+
+def raw_csv_bytes(shots: ShotColumns):
+    return csv_buffer(zip(*shots.values()), RAW_HEADER_BYTES)
+
+def build_stats_files(shots: ShotColumns):
+    """Оба CSV для /stats. Чистая CPU-работа — вызывается через asyncio.to_thread."""
+    if shot_count(shots) >= PANDAS_MIN_SHOTS:
+        try:
+            return stats_csv_bytes_pandas(shots), raw_csv_bytes(shots)
+        except ImportError:
+            pass
+    return csv_bytes_from_rows(compute_stats_by_club(shots)), raw_csv_bytes(shots)
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
-    if not core["shots"]:
+    if not shot_count(core["shots"]):
         return await update.message.reply_text("No shots yet in this session.")
-    rows = compute_stats_by_club(core["shots"])
-    stats_file = csv_bytes_from_rows(rows); stats_file.name = "stats_by_club.csv"
-    raw_file = raw_csv_bytes(core["shots"]);  raw_file.name = "raw_shots.csv"
+    stats_file, raw_file = await asyncio.to_thread(build_stats_files, snapshot_columns(core["shots"]))
 
     await update.message.reply_text(
         "Statistics are percentages per club within the current session.\n"
         "Sending two CSVs for Google Sheets:"
     )
-    await update.message.reply_document(InputFile(stats_file))
-    await update.message.reply_document(InputFile(raw_file))
+    await asyncio.gather(
+        update.message.reply_document(document=stats_file, filename="stats_by_club.csv"),
+        update.message.reply_document(document=raw_file, filename="raw_shots.csv"),
+    )
 
 async def cmd_end_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Вместо мгновенного завершения — спросим про статистику
     await ask_end_session_stats(update, context)
 
 # ---- Common shot flow ----
+# Шаги удара по порядку: (поле Shot, допустимые ответы *_MAP, вопрос, клавиатура).
+# Текущий шаг — первое незаполненное поле; когда заполнены все — Review.
+NON_PUTT_STEPS = [
+    ("shot_type", SHOT_TYPES_MAP, "Choose Type:", KB_TYPE),
+    ("lie", LIES_MAP, "Lie?", KB_LIE),
+    ("club", CLUBS_MAP, "Club?", KB_CLUB),
+    ("result", RESULT_NON_PUTT_MAP, "Result?", KB_RESULT_NONPUTT),
+    ("contact", CONTACT_NON_PUTT_MAP, "Contact?", KB_CONTACT_NONPUTT),
+    ("plan", PLAN_MAP, "Plan?", KB_PLAN),
+]
+PUTT_STEPS = [
+    ("shot_type", SHOT_TYPES_MAP, "Choose Type:", KB_TYPE),
+    ("putt_distance", PUTT_DISTANCE_MAP, "Distance?", KB_PUTT_DISTANCE),
+    ("lie", LIES_MAP, "Lie?", KB_LIE),
+    ("club", CLUBS_MAP, "Club?", KB_CLUB),
+    ("putt_result", RESULT_PUTT_MAP, "Result?", KB_RESULT_PUTT),
+    ("putt_contact", CONTACT_PUTT_MAP, "Contact?", KB_CONTACT_PUTT),
+    ("putt_plan_1", PLAN_MAP, "Plan?", KB_PLAN),
+    ("lag_reading", LAG_MAP, "Lag putt reading?", KB_LAG),
+    ("putt_plan_2", PLAN_MAP, "Plan (after lag)?", KB_PLAN),
+]
+
+def current_step(s: Shot):
+    """Первый незаполненный шаг удара или None, если всё заполнено."""
+    for step in (PUTT_STEPS if s.shot_type == "putt" else NON_PUTT_STEPS):
+        if getattr(s, step[0]) is None:
+            return step
+    return None
+
+# Вызывается через any_text (или из handle_practice_setup): ответ по статистике
+# и управляющие кнопки уже обработаны там.
 async def shot_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
     s: Shot | None = core["current"]
-
-    # Если ждём ответ по статистике — обрабатываем его прежде всего
+    mode = core["mode"]
     text = update.message.text
-    if core.get("awaiting_end_stats"):
-        handled = await handle_end_session_choice(update, context, text)
-        if handled: return
 
     # Подготовка для practice (быстрые подряд удары)
     if s is None:
-        if core["mode"] == "practice":
-            if core["practice"]["lie"] and core["practice"]["club"]:
+        if mode == "practice":
+            practice = core["practice"]
+            if practice["lie"] and practice["club"]:
                 start_new_shot(core); s = core["current"]
             else:
                 return  # ещё выбираем sticky lie/club
-        elif core["mode"] == "oncourse":
-            return await update.message.reply_text("Start a shot with /shot")
+        elif mode == "oncourse":
+            return await reply(update, core, "Start a shot with /shot")
         else:
-            return await update.message.reply_text("Use /start to choose mode.")
-
-    # Управляющие кнопки
-    if await handle_controls(text, update, context):
-        return
+            return await reply(update, core, "Use /start to choose mode.")
 
     # Назад
     if text == BACK:
         if pop_state(core):
-            return await reask_step(update, core["current"])
-        return await update.message.reply_text("Nothing to go back to.")
+            return await reask_step(update, core)
+        return await reply(update, core, "Nothing to go back to.")
 
     # Отмена
     if text == CANCEL:
         core["current"] = None
         core["stack"] = []
-        if core["mode"] == "practice":
-            return await update.message.reply_text("Shot canceled.\nNew shot: choose Type", reply_markup=kb_type())
-        return await update.message.reply_text("Shot canceled. Start new with /shot", reply_markup=ReplyKeyboardRemove())
+        if mode == "practice":
+            return await reply(update, core, "Shot canceled.\nNew shot: choose Type", keyboard=KB_TYPE)
+        return await reply(update, core, "Shot canceled. Start new with /shot", keyboard=KB_REMOVE)
 
     # Подтверждение
     if text == CONFIRM:
-        core["shots"].append(core["current"])
+        append_shot(core["shots"], s)
+        core["log_pending"].append(s.as_row())
+        pending = take_shot_log(core) if len(core["log_pending"]) >= SHOT_LOG_FLUSH_EVERY else None
         core["current"] = None
         core["stack"] = []
-        if core["mode"] == "practice":
+        if mode == "practice":
             start_new_shot(core)
-            return await update.message.reply_text("Saved ✅\nNew shot: choose Type", reply_markup=kb_type())
-        return await update.message.reply_text("Saved ✅\nAdd next: /shot", reply_markup=ReplyKeyboardRemove())
+            await save_shot_log(pending)
+            return await reply(update, core, "Saved ✅\nNew shot: choose Type", keyboard=KB_TYPE)
+        await save_shot_log(pending)
+        return await reply(update, core, "Saved ✅\nAdd next: /shot", keyboard=KB_REMOVE)
 
     # Progression
-    # Type
-    if s.shot_type is None:
-        if text in SHOT_TYPES:
-            push_state(core); s.shot_type = text
-            if s.shot_type == "putt":
-                return await update.message.reply_text("Distance?", reply_markup=kb_putt_distance())
-            # non-putt: ensure lie/club
-            if s.lie is None:
-                return await update.message.reply_text("Lie?", reply_markup=kb_lie())
-            if s.club is None:
-                return await update.message.reply_text("Club?", reply_markup=kb_club())
-            return await update.message.reply_text("Result?", reply_markup=kb_result(False))
-        return await update.message.reply_text("Choose Type:", reply_markup=kb_type())
-
-    # Non-putt branch
-    if s.shot_type != "putt":
-        if s.lie is None:
-            if text in LIES:
-                push_state(core); s.lie = text
-                return await update.message.reply_text("Club?", reply_markup=kb_club())
-            return await update.message.reply_text("Lie?", reply_markup=kb_lie())
-        if s.club is None:
-            if text in CLUBS:
-                push_state(core); s.club = text
-                return await update.message.reply_text("Result?", reply_markup=kb_result(False))
-            return await update.message.reply_text("Club?", reply_markup=kb_club())
-        if s.result is None:
-            if text in RESULT_NON_PUTT:
-                push_state(core); s.result = text
-                return await update.message.reply_text("Contact?", reply_markup=kb_contact(False))
-            return await update.message.reply_text("Result?", reply_markup=kb_result(False))
-        if s.contact is None:
-            if text in CONTACT_NON_PUTT:
-                push_state(core); s.contact = text
-                return await update.message.reply_text("Plan?", reply_markup=kb_plan())
-            return await update.message.reply_text("Contact?", reply_markup=kb_contact(False))
-        if s.plan is None:
-            if text in PLAN_CHOICES:
-                push_state(core); s.plan = text
-                return await update.message.reply_text(f"Review:\n{summarize(s)}", reply_markup=kb_confirm())
-            return await update.message.reply_text("Plan?", reply_markup=kb_plan())
-
-    # Putt branch
-    else:
-        if s.putt_distance is None:
-            if text in PUTT_DISTANCE:
-                push_state(core); s.putt_distance = text
-                if s.lie is None:
-                    return await update.message.reply_text("Lie?", reply_markup=kb_lie())
-                if s.club is None:
-                    return await update.message.reply_text("Club?", reply_markup=kb_club())
-                return await update.message.reply_text("Result?", reply_markup=kb_result(True))
-            return await update.message.reply_text("Distance?", reply_markup=kb_putt_distance())
-        if s.lie is None:
-            if text in LIES:
-                push_state(core); s.lie = text
-                return await update.message.reply_text("Club?", reply_markup=kb_club())
-            return await update.message.reply_text("Lie?", reply_markup=kb_lie())
-        if s.club is None:
-            if text in CLUBS:
-                push_state(core); s.club = text
-                return await update.message.reply_text("Result?", reply_markup=kb_result(True))
-            return await update.message.reply_text("Club?", reply_markup=kb_club())
-        if s.putt_result is None:
-            if text in RESULT_PUTT:
-                push_state(core); s.putt_result = text
-                return await update.message.reply_text("Contact?", reply_markup=kb_contact(True))
-            return await update.message.reply_text("Result?", reply_markup=kb_result(True))
-        if s.putt_contact is None:
-            if text in CONTACT_PUTT:
-                push_state(core); s.putt_contact = text
-                return await update.message.reply_text("Plan?", reply_markup=kb_plan())
-            return await update.message.reply_text("Contact?", reply_markup=kb_contact(True))
-        if s.putt_plan_1 is None:
-            if text in PLAN_CHOICES:
-                push_state(core); s.putt_plan_1 = text
-                return await update.message.reply_text("Lag putt reading?", reply_markup=kb_lag())
-            return await update.message.reply_text("Plan?", reply_markup=kb_plan())
-        if s.lag_reading is None:
-            if text in LAG_PUTT:
-                push_state(core); s.lag_reading = text
-                return await update.message.reply_text("Plan (after lag)?", reply_markup=kb_plan())
-            return await update.message.reply_text("Lag putt reading?", reply_markup=kb_lag())
-        if s.putt_plan_2 is None:
-            if text in PLAN_CHOICES:
-                push_state(core); s.putt_plan_2 = text
-                return await update.message.reply_text(f"Review:\n{summarize(s)}", reply_markup=kb_confirm())
-            return await update.message.reply_text("Plan (after lag)?", reply_markup=kb_plan())
-
-async def reask_step(update: Update, s: Shot):
-    if s.shot_type is None:
-        return await update.message.reply_text("Choose Type:", reply_markup=kb_type())
-    if s.shot_type != "putt":
-        if s.lie is None:   return await update.message.reply_text("Lie?", reply_markup=kb_lie())
-        if s.club is None:  return await update.message.reply_text("Club?", reply_markup=kb_club())
-        if s.result is None:return await update.message.reply_text("Result?", reply_markup=kb_result(False))
-        if s.contact is None:return await update.message.reply_text("Contact?", reply_markup=kb_contact(False))
-        if s.plan is None: return await update.message.reply_text("Plan?", reply_markup=kb_plan())
-        return await update.message.reply_text(f"Review:\n{summarize(s)}", reply_markup=kb_confirm())
-    else:
-        if s.putt_distance is None: return await update.message.reply_text("Distance?", reply_markup=kb_putt_distance())
-        if s.lie is None:           return await update.message.reply_text("Lie?", reply_markup=kb_lie())
-        if s.club is None:          return await update.message.reply_text("Club?", reply_markup=kb_club())
-        if s.putt_result is None:   return await update.message.reply_text("Result?", reply_markup=kb_result(True))
-        if s.putt_contact is None:  return await update.message.reply_text("Contact?", reply_markup=kb_contact(True))
-        if s.putt_plan_1 is None:   return await update.message.reply_text("Plan?", reply_markup=kb_plan())
-        if s.lag_reading is None:   return await update.message.reply_text("Lag putt reading?", reply_markup=kb_lag())
-        if s.putt_plan_2 is None:   return await update.message.reply_text("Plan (after lag)?", reply_markup=kb_plan())
-        return await update.message.reply_text(f"Review:\n{summarize(s)}", reply_markup=kb_confirm())
+    step = current_step(s)
+    if step is None:
+        return
+    field, choices, prompt, keyboard = step
+    value = choices.get(text)
+    if value is None:
+        return await reply(update, core, prompt, keyboard=retry_markup(core, text, keyboard))
+    push_state(core, field); setattr(s, field, value)
+    return await reask_step(update, core)
+
+async def reask_step(update: Update, core):
+    s: Shot = core["current"]
+    step = current_step(s)
+    if step is None:
+        return await reply(update, core, f"Review:\n{summarize(s)}", keyboard=KB_CONFIRM)
+    _, _, prompt, keyboard = step
+    return await reply(update, core, prompt, keyboard=keyboard)
 
 # ---- Router ----
+# В сессии храним строковый ключ, а не саму функцию: user_data пиклится в bot_state.pkl,
+# и ссылка вида __main__.shot_flow ломала бы загрузку после переименования/другого запуска.
+ROUTES = {
+    "mode": handle_mode,
+    "practice_setup": handle_practice_setup,
+    "shot": shot_flow,
+}
+
+# Управляющие кнопки (MAIN_MENU, END_SESSION_BTN) сюда не попадают — у них свои
+# MessageHandler'ы в main(), зарегистрированные раньше этого.
 async def any_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     core = ensure_session(context)
     text = update.message.text
@@ -656,39 +780,131 @@ async def any_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         handled = await handle_end_session_choice(update, context, text)
         if handled: return
 
-    # Управляющие кнопки доступны всегда
-    if await handle_controls(text, update, context):
-        return
-
-    if core["mode"] is None:
-        return await handle_mode(update, context)
+    # handle_mode → handle_practice_setup (practice, пока нет sticky) → shot_flow
+    return await ROUTES[core["router"]](update, context)
 
-    if core["mode"] == "practice":
-        if core["practice"]["lie"] is None or core["practice"]["club"] is None:
-            return await handle_practice_setup(update, context)
-        return await shot_flow(update, context)
+# ======= STATE =======
+# PTB раз в STATE_FLUSH_INTERVAL копирует изменённые user_data в память персистенса (on_flush=True —
+# без записи на диск). Файл целиком пишем сами, одной записью за интервал: в отдельном потоке
+# и через tmp + os.replace, чтобы kill посреди записи не оставил обрезанный bot_state.pkl.
+_state_lock = threading.Lock()
 
-    if core["mode"] == "oncourse":
-        return await shot_flow(update, context)
+def write_state(path: str, state: dict) -> bool:
+    tmp = f"{path}.tmp"
+    try:
+        with _state_lock:
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        return True
+    except OSError as e:
+        print(f"WARNING: state save failed: {e}", file=sys.stderr, flush=True)
+        return False
 
-    return await update.message.reply_text("Use /start to choose mode.")
+class StatePersistence(PicklePersistence):
+    """PicklePersistence с записью файла вне event loop и только при изменениях."""
+    _dirty = False
+    _flush_task = None
+
+    async def update_user_data(self, user_id: int, data: dict):
+        await super().update_user_data(user_id, data)
+        if self.user_data.get(user_id) is data:   # PTB принял новую копию (равные данные он пропускает)
+            self._dirty = True
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        # Формат файла — как у PicklePersistence (single_file). Снимок словаря берём в event loop:
+        # PTB дальше только подменяет в нём значения, сами скопированные user_data не меняются.
+        state = {
+            "conversations": self.conversations,
+            "user_data": dict(self.user_data or {}),
+            "chat_data": self.chat_data,
+            "bot_data": self.bot_data,
+            "callback_data": self.callback_data,
+        }
+        if not await asyncio.to_thread(write_state, str(self.filepath), state):
+            self._dirty = True
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start_flushing(self):
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    def stop_flushing(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+
+async def start_state_flush(app):
+    """post_init: фоновая запись состояния (JobQueue отключён)."""
+    app.persistence.start_flushing()
+
+async def stop_state_flush(app):
+    """post_shutdown: финальную запись уже сделал PTB (persistence.flush() в shutdown)."""
+    app.persistence.stop_flushing()
 
 # ======= MAIN =======
+async def flush_shot_logs(app):
+    """post_stop: дописать незаписанные удары всех пользователей и сохранить опустевшие очереди."""
+    pending = []
+    for user_id, data in app.user_data.items():
+        p = take_shot_log(data["core"]) if "core" in data else None
+        if p is not None:
+            pending.append(p)
+            app.mark_data_for_update_persistence(user_ids=user_id)
+    await asyncio.gather(*(save_shot_log(p) for p in pending))
+    await app.update_persistence()
+
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+    # Апдейты разных пользователей обрабатываются параллельно (состояние — в ctx.user_data).
+    # JobQueue боту не нужен; Updater оставляем — на нём работают и run_webhook, и run_polling.
+    os.makedirs(DATA_DIR, exist_ok=True)
+    persistence = StatePersistence(
+        filepath=STATE_FILE,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+        on_flush=True,
+        update_interval=STATE_FLUSH_INTERVAL,
+    )
+    app = ApplicationBuilder().token(TOKEN).persistence(persistence) \
+        .job_queue(None).concurrent_updates(True) \
+        .post_init(start_state_flush).post_stop(flush_shot_logs).post_shutdown(stop_state_flush).build()
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("shot", cmd_shot))
     app.add_handler(CommandHandler("next_hole", cmd_next_hole))
     app.add_handler(CommandHandler("stats", cmd_stats))
     app.add_handler(CommandHandler("end_session", cmd_end_session))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, any_text))
+    # Управляющие кнопки доступны всегда — отдельные хендлеры до общего роутера
+    app.add_handler(MessageHandler(filters.Text([MAIN_MENU]), go_main_menu, block=False))
+    app.add_handler(MessageHandler(filters.Text([END_SESSION_BTN]), ask_end_session_stats, block=False))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, any_text, block=False))
 
     try:
-        print("Bot polling starting…", flush=True)
-        app.run_polling()
+        if WEBHOOK_URL:
+            print(f"Bot webhook starting on port {PORT}…", flush=True)
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=TOKEN,
+                webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=[Update.MESSAGE],
+            )
+        else:
+            print("Bot polling starting…", flush=True)
+            # long-poll: Telegram держит getUpdates до 30 с — меньше пустых запросов
+            app.run_polling(
+                timeout=30,
+                poll_interval=0.0,
+                bootstrap_retries=-1,
+                allowed_updates=[Update.MESSAGE],
+            )
     except Exception:
-        print("FATAL: unhandled exception in run_polling()", file=sys.stderr, flush=True)
+        print("FATAL: unhandled exception in main loop", file=sys.stderr, flush=True)
         traceback.print_exc()
         sys.exit(1)
 